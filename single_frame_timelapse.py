@@ -3,13 +3,22 @@
 Create a timelapse photo by taking a slice from each frame
 and condensing it into a single image.
 """
+from __future__ import division, print_function
 import os
 import sys
+import mmap
+from collections import deque
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
 import cv2
 import numpy as np
 
+PROGRESS_INTERVAL = 256  # frames between progress updates
 
-def SFTL(**kwargs):
+
+def SFTL(stills=None, video=None, youtube=None, slice=None, mirror=None,
+         stretch=None, fixedwidth=False, draft=None, compression=None,
+         debug=False):
     """Create a timelapse photo.
 
     Notes:
@@ -45,145 +54,239 @@ def SFTL(**kwargs):
                         to keep the aspect ratio of the original image.
                         Otherwise, a large number of input frames will
                         create a very wide image.
+            draft: Decode still images at a reduced size for a quicker,
+                   lower resolution preview (stills input only).
+                   2, 4, or 8 to read images at 1/2, 1/4, or 1/8 scale.
 
+        compression: PNG compression level (0 - 9) of the output image.
+                     By default, OpenCV's fast run-length encoding is used.
+                     Set a level to write a smaller file more slowly.
         debug: Output debug info.
 
     Examples:
         SFTL(stills='frames')
         SFTL(stills='frames', slice=0.5, mirror='half')
+        SFTL(stills='frames', draft=4)
         SFTL(video='car.avi', slice=0.75, stretch=2)
         SFTL(youtube='https://youtu.be/DmYK479EpQc', slice=0.5)
 
     """
 
-    stills = None
-    video = None
-    youtube = None
-    slicelocation = None
-    mirror = None
-    stretch = None
-    fixedwidth = False
-    debug = False
-    for key in kwargs:
-        if key == 'slice': slicelocation = kwargs[key]
-        if key == 'mirror': mirror = kwargs[key]
-        if key == 'stills': stills = kwargs[key]
-        if key == 'video': video = kwargs[key]
-        if key == 'youtube': youtube = kwargs[key]
-        if key == 'stretch': stretch = kwargs[key]
-        if key == 'fixedwidth': fixedwidth = kwargs[key]
-        if key == 'debug': debug = kwargs[key]
-
-    def add(img1, img2):
-        'Combine left and right images.'
-        img = np.concatenate((img1, img2), axis=1)
-        return img
-
-    def add_slice(TLP, frame_count, i, frame):
-        'Determine slice location and width.'
-        _, img_width, _ = frame.shape
-        if slicelocation is not None:
-            left = int(slicelocation * img_width)
-        if mirror == 'half': img_width /= 2
+    slicelocation = slice
+    draft_flags = {2: cv2.IMREAD_REDUCED_COLOR_2,
+                   4: cv2.IMREAD_REDUCED_COLOR_4,
+                   8: cv2.IMREAD_REDUCED_COLOR_8}
+    if draft is not None and stills is None:
+        raise ValueError("draft is only available for stills input.")
+    if draft is not None and draft not in draft_flags:
+        raise ValueError("draft must be 2, 4, or 8, not {}.".format(draft))
+
+    def slice_geometry(frame_count, img_width):
+        'Determine slice location and width for each frame.'
+        frame_width = img_width
+        i = np.arange(frame_count)
+        if mirror == 'half': img_width >>= 1
         slice_width_float = img_width / frame_count
         slice_width = int(slice_width_float)
         if slice_width < 1: slice_width = 1
-        if slicelocation is None:
-            left = slice_width * i
-            if left > slice_width_float * i:
-                left = int(slice_width_float * i)
+        if slicelocation is not None:
+            lefts = np.full(len(i), int(slicelocation * frame_width), int)
+        else:
+            lefts = np.minimum(slice_width * i,
+                               (slice_width_float * i).astype(int))
         if stretch is not None and stretch < 1:
-            slice_width = int(slice_width * stretch)
-            if slice_width < 1: slice_width = 1
-            right = left + slice_width
+            new_slice_width = max(int(slice_width * stretch), 1)
         elif stretch is not None:
-            right = left + int(slice_width * stretch)
+            new_slice_width = int(slice_width * stretch)
         else:
-            right = left + slice_width
-
-        if i == 0:
-            TLP = frame[:, 0:0]
+            new_slice_width = slice_width
+        widths = np.full(len(i), new_slice_width, int)
 
         # Fixed width option processing
-        new_slice_width = right - left
         final_width = new_slice_width * frame_count
         if final_width > img_width and fixedwidth and new_slice_width == 1:
-            k = int(frame_count / img_width)
-            if i % k != 0:
-                return TLP
+            k = frame_count // img_width
+            widths[i % k != 0] = 0
         elif fixedwidth:
             add_stretch = img_width / (new_slice_width * frame_count)
-            right = left + int(new_slice_width * add_stretch)
+            widths[:] = int(new_slice_width * add_stretch)
+
+        widths = np.maximum(np.minimum(lefts + widths, frame_width) - lefts, 0)
+        offsets = np.cumsum(widths) - widths
+        return lefts, widths, offsets
 
-        TLP = add(TLP, frame[:, left:right])
+    def new_timelapse(frame_count, img_height, img_width):
+        'Allocate the timelapse image for the calculated slices.'
+        geometry = slice_geometry(frame_count, img_width)
+        width = geometry[1].sum()
+        if mirror is not None: width *= 2
+        # Stored transposed so each slice is a contiguous block of rows
+        TLP = np.empty((width, img_height, 3), np.uint8)
+        return TLP, geometry
 
-        if debug:
-            print '{}/{} s={},{},{} {}'.format(
-                i, frame_count, slice_width, left, right, TLP.shape)
+    def trim_timelapse(TLP, width):
+        'Remove space reserved for slices that were not added.'
+        if mirror is not None:
+            return np.concatenate((TLP[:width], TLP[len(TLP) - width:]))
+        return TLP[:width]
+
+    def get_slice(geometry, i, frame):
+        'Get the slice of a frame, transposed to rows.'
+        lefts, widths, _ = geometry
+        return frame[:, lefts[i]:lefts[i] + widths[i]].transpose(1, 0, 2)
 
-        return TLP
+    def add_forward_slice(TLP, geometry, i, frame_slice):
+        'Copy a frame slice into the timelapse.'
+        _, widths, offsets = geometry
+        offset = offsets[i]
+        TLP[offset:offset + widths[i]] = frame_slice
+
+    def add_mirrored_slice(TLP, geometry, i, frame_slice):
+        'Copy a frame slice and its mirror image into the timelapse.'
+        _, widths, offsets = geometry
+        width, offset = widths[i], offsets[i]
+        end = len(TLP) - offset
+        TLP[offset:offset + width] = frame_slice
+        TLP[end - width:end] = TLP[offset:offset + width][::-1]
+
+    # Choose once instead of checking the mirror option for every frame
+    if mirror is not None:
+        add_slice = add_mirrored_slice
+    else:
+        add_slice = add_forward_slice
+
+    def debug_slice(TLP, geometry, i):
+        'Print slice debug info.'
+        lefts, widths, offsets = geometry
+        left, width, offset = int(lefts[i]), int(widths[i]), int(offsets[i])
+        # Shape of the (untransposed) timelapse so far
+        shape = (TLP.shape[1], offset + width, TLP.shape[2])
+        print('{}/{} s={},{},{} {}'.format(
+            i, len(lefts), width, left, left + width, shape))
 
     def save(TLP):
         'Save image.'
-        if mirror is not None:
-            TLP = add(TLP, cv2.flip(TLP, 1))
+        TLP = cv2.transpose(TLP)
 
-        filename = "SFTL"
+        name_parts = ["SFTL"]
         if stills is not None:
-            filename += "_{}".format(stills)
+            name_parts.append(str(stills))
         elif video is not None:
-            filename += "_{}".format(video)
+            name_parts.append(str(video))
         if slicelocation is not None:
-            filename += "_slice={}".format(slicelocation)
+            name_parts.append("slice={}".format(slicelocation))
         if mirror is not None:
-            filename += "_{}-mirror".format(mirror)
+            name_parts.append("{}-mirror".format(mirror))
         if stretch is not None:
-            filename += "_stretch={}".format(stretch)
+            name_parts.append("stretch={}".format(stretch))
         if fixedwidth:
-            filename += "_fixedwidth"
-        filename += ".png"
-        cv2.imwrite(filename, TLP)
+            name_parts.append("fixedwidth")
+        if draft is not None:
+            name_parts.append("draft={}".format(draft))
+        filename = "_".join(name_parts) + ".png"
+        params = []
+        if compression is not None:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, compression]
+        cv2.imwrite(filename, TLP, params)
+
+    def read_image(filename):
+        'Decode an image from a memory map of its file.'
+        if draft is not None:
+            # Not every OpenCV version applies reduced flags in imdecode
+            return cv2.imread(filename, draft_flags[draft])
+        with open(filename, 'rb') as image_file:
+            data = mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+    def add_image(TLP, geometry, i, filename):
+        'Read an image and add its slice to the timelapse.'
+        if not geometry[1][i]:
+            return  # Skip decoding images that do not add a slice
+        frame = read_image(filename)
+        add_slice(TLP, geometry, i, get_slice(geometry, i, frame))
+
+    def add_images(TLP, geometry, filenames):
+        'Add image slices in other threads, yielding each index in order.'
+        # Each image fills its own rows of the timelapse, so no locking.
+        # Consecutive images are in flight together, so the rows being
+        # written at any time are one small block of the timelapse.
+        threads = cpu_count()
+        prefetch = 2 * threads
+        pool = ThreadPool(threads)
+        pending = deque()
+        try:
+            for i, filename in enumerate(filenames):
+                pending.append(pool.apply_async(
+                    add_image, (TLP, geometry, i, filename)))
+                if len(pending) >= prefetch:
+                    pending.popleft().get()
+                    yield i - len(pending)
+            while pending:
+                pending.popleft().get()
+                yield len(filenames) - len(pending) - 1
+        finally:
+            pool.terminate()
 
     def process_stills():
         'Create SFTL from still images.'
-        TLP = None
-        frame_files = sorted([name for name in os.listdir(stills)
-                              if os.path.isfile(os.path.join(stills, name))])
+        if hasattr(os, 'scandir'):
+            # Directory entry types avoid a stat() call for each file
+            frame_files = sorted(entry.name for entry in os.scandir(stills)
+                                 if entry.is_file())
+        else:
+            frame_files = sorted(name for name in os.listdir(stills)
+                                 if os.path.isfile(os.path.join(stills, name)))
         frame_count = len(frame_files)
-        print "{} images to include from '{}'.".format(frame_count, stills)
-        for i, frame_file in enumerate(frame_files):
-            filename = stills + "/" + frame_file
-            sys.stdout.write('\rProcessing file: {}'.format(filename))
-            sys.stdout.flush()
-            frame = cv2.imread(filename)
-            TLP = add_slice(TLP, frame_count, i, frame)
+        print("{} images to include from '{}'.".format(frame_count, stills))
+        filenames = [stills + "/" + frame_file for frame_file in frame_files]
+        img_height, img_width, _ = read_image(filenames[0]).shape
+        TLP, geometry = new_timelapse(frame_count, img_height, img_width)
+        for i in add_images(TLP, geometry, filenames):
+            if i % PROGRESS_INTERVAL == 0 or i == frame_count - 1:
+                sys.stdout.write('\rProcessing file: {}'.format(filenames[i]))
+                sys.stdout.flush()
+            if debug and geometry[1][i]: debug_slice(TLP, geometry, i)
         save(TLP)
 
     def process_video():
         'Create SFTL from video frames.'
-        TLP = None
         video_input = cv2.VideoCapture(video)
-        frame_count = video_input.get(cv2.CAP_PROP_FRAME_COUNT)
-        print "{} frames to include from '{}'.".format(frame_count, video)
+        video_input.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        frame_count = int(video_input.get(cv2.CAP_PROP_FRAME_COUNT))
+        print("{} frames to include from '{}'.".format(frame_count, video))
+        img_height = int(video_input.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        img_width = int(video_input.get(cv2.CAP_PROP_FRAME_WIDTH))
+        TLP, geometry = new_timelapse(frame_count, img_height, img_width)
+        widths = geometry[1]
+        last = len(widths) - 1
         i = 0
-        while video_input.isOpened():
-            sys.stdout.write('\rProcessing frame: {}'.format(i))
-            sys.stdout.flush()
-            ret, frame = video_input.read()
-            if not ret: break
-            TLP = add_slice(TLP, frame_count, i, frame)
+        while i <= last:
+            if i % PROGRESS_INTERVAL == 0 or i == last:
+                sys.stdout.write('\rProcessing frame: {}'.format(i))
+                sys.stdout.flush()
+            if not video_input.grab(): break
+            if widths[i]:
+                # Only decode frames that contribute a slice
+                frame = video_input.retrieve()[1]
+                add_slice(TLP, geometry, i, get_slice(geometry, i, frame))
+                del frame
+                if debug: debug_slice(TLP, geometry, i)
             i += 1
         video_input.release()
+        if i < len(widths):
+            # Fewer frames were read than the reported frame count
+            TLP = trim_timelapse(TLP, geometry[2][i])
         save(TLP)
 
-    print '-' * 30
-    options = [slicelocation, mirror, stretch]
+    print('-' * 30)
+    options = [slicelocation, mirror, stretch, draft]
     if any(option is not None for option in options) or fixedwidth:
-        print "Processing options:"
-        if slicelocation is not None: print "  Slice = {}".format(slicelocation)
-        if mirror is not None: print "  Mirror = {}".format(mirror)
-        if stretch is not None: print "  Stretch = {}".format(stretch)
-        if fixedwidth: print "  Fixed Width = True"
+        print("Processing options:")
+        if slicelocation is not None: print("  Slice = {}".format(slicelocation))
+        if mirror is not None: print("  Mirror = {}".format(mirror))
+        if stretch is not None: print("  Stretch = {}".format(stretch))
+        if fixedwidth: print("  Fixed Width = True")
+        if draft is not None: print("  Draft = 1/{} scale".format(draft))
 
     if stills is not None:
         process_stills()
@@ -193,7 +296,7 @@ def SFTL(**kwargs):
         from pytube import YouTube
         yt = YouTube(youtube)
         video = yt.filename + '.mp4'
-        if debug: print yt.get_videos()
+        if debug: print(yt.get_videos())
         video_to_dl = yt.get('mp4', '720p')
         try:
             open(video)
@@ -201,34 +304,53 @@ def SFTL(**kwargs):
             video_to_dl.download('.')
         process_video()
     else:
-        print "Please input either stills='frames', " + \
-              "video='name.avi', or youtube='<url>'.\n" + \
-              "View help(SFTL) for more information."
-    print '\n' + '-' * 30
+        print("Please input either stills='frames', " +
+              "video='name.avi', or youtube='<url>'.\n" +
+              "View help(SFTL) for more information.")
+    print('\n' + '-' * 30)
+
+
+def test_options(source):
+    """Create a timelapse of one input for each combination of test options.
+
+    Arguments:
+        source: dictionary of the input argument for SFTL,
+                such as {'stills': 'frames'}.
+
+    """
+    slice_locations = [None, 0.5]  # horizontal location (percent)
+    mirror_methods = [None, 'full', 'half']
+    time_stretches = [None, 0.5, 2]
+
+    for slice_begin in slice_locations:
+        for mirror_method in mirror_methods:
+            for time_stretch in time_stretches:
+                SFTL(slice=slice_begin,
+                     mirror=mirror_method,
+                     stretch=time_stretch,
+                     **source)
 
 if __name__ == "__main__":
     SFTL()
 
     # Tests
     if len(sys.argv) > 1 and sys.argv[1] == 'tests':
-        SLICE_LOCATIONS = [None, 0.5]  # horizontal location (percent)
-        MIRROR_METHODS = [None, 'full', 'half']
-        TIME_STRETCHES = [None, 0.5, 2]
-
-        for slice_begin in SLICE_LOCATIONS:
-            for mirror_method in MIRROR_METHODS:
-                for time_stretch in TIME_STRETCHES:
-                    SFTL(stills='frames',
-                         slice=slice_begin,
-                         mirror=mirror_method,
-                         stretch=time_stretch)
-
-                    SFTL(video='car.avi',
-                         slice=slice_begin,
-                         mirror=mirror_method,
-                         stretch=time_stretch)
-
-                    SFTL(youtube='https://youtu.be/DmYK479EpQc',
-                         slice=slice_begin,
-                         mirror=mirror_method,
-                         stretch=time_stretch)
+        SOURCES = [{'stills': 'frames'},
+                   {'video': 'car.avi'},
+                   {'youtube': 'https://youtu.be/DmYK479EpQc'}]
+
+        # The inputs are independent, so each is run in its own process
+        pool = Pool(len(SOURCES))
+        results = [pool.apply_async(test_options, (source,))
+                   for source in SOURCES]
+        pool.close()
+        pool.join()  # Let every input finish before reporting failures
+        failed = False
+        for source, result in zip(SOURCES, results):
+            try:
+                result.get()
+            except Exception as error:
+                print('\nTests failed for {}: {!r}'.format(source, error))
+                failed = True
+        if failed:
+            sys.exit(1)